@@ -1,3 +1,3 @@
 import os
 
-from . import ldap, ppms, redmine, util
+from . import ldap, policy, ppms, redmine, util
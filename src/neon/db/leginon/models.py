@@ -1,4 +1,115 @@
+from typing import Any, ClassVar, Generator, Tuple, TypeVar
+
 from django.db import models
+from django.db.models.functions import Length
+from django.db.models.lookups import Exact
+
+_M = TypeVar("_M", bound=models.Model)
+
+
+class StreamQuerySet(models.QuerySet[_M]):
+    """keyset pagination for the big tables: rows are read in def_id order,
+    batch at a time, each batch by def_id > the last one seen rather than
+    by OFFSET, so every query costs the same however deep it starts"""
+
+    def stream(
+        self, *fields: str, after: int = 0, batch: int = 10000
+    ) -> Generator[Tuple[Any, ...], None, None]:
+        """(def_id, *fields) of every row past def_id after; a stream cut
+        short is resumed by passing the last def_id seen as after"""
+        rows = self.order_by("def_id").values_list("def_id", *fields)
+        while True:
+            page = list(rows.filter(def_id__gt=after)[:batch])
+            yield from page
+            if len(page) < batch:
+                return
+            after = page[-1][0]
+
+    def stream_objects(
+        self, after: int = 0, batch: int = 1000
+    ) -> Generator[_M, None, None]:
+        "stream() yielding model instances"
+        rows = self.order_by("def_id")
+        while True:
+            page = list(rows.filter(def_id__gt=after)[:batch])
+            yield from page
+            if len(page) < batch:
+                return
+            after = page[-1].pk
+
+
+class JoinedManager(models.Manager[_M]):
+    """the default manager of the tables with foreign keys: querysets follow
+    the model's joined chains in the same query (select_related), so
+    __str__ and listings don't cost a query per row per hop.
+    .select_related(None) drops the joins."""
+
+    def get_queryset(self) -> models.QuerySet[_M]:
+        joined = getattr(self.model, "joined", ())
+        return super().get_queryset().select_related(*joined)
+
+
+# one concrete class per model: mypy can't type a generic manager class
+# attribute
+
+
+class _SessionManager(JoinedManager["SessionData"]):
+    pass
+
+
+class _CameraQuerySet(StreamQuerySet["CameraEMData"]):
+    pass
+
+
+class _CameraJoined(JoinedManager["CameraEMData"]):
+    pass
+
+
+_CameraManager = _CameraJoined.from_queryset(_CameraQuerySet)
+
+
+class _ImageQuerySet(StreamQuerySet["AcquisitionImageData"]):
+    pass
+
+
+class _ImageJoined(JoinedManager["AcquisitionImageData"]):
+    pass
+
+
+_ImageManager = _ImageJoined.from_queryset(_ImageQuerySet)
+
+
+def _blank_or_x(field: str) -> models.Q:
+    "field is null, empty or starts with x-, as in UserData.closed()"
+    # = '' would also match blanks under MySQL's padding collations
+    return (
+        models.Q(**{f"{field}__isnull": True})
+        | models.Q(Exact(Length(field), 0))
+        | models.Q(**{f"{field}__startswith": "x-"})
+    )
+
+
+def _closed() -> models.Q:
+    return (
+        _blank_or_x("firstname")
+        & _blank_or_x("lastname")
+        & models.Q(noleginon=1)
+    )
+
+
+class UserQuerySet(models.QuerySet["UserData"]):
+    """UserData.closed() and hidden() as filters.  Prefixes are matched
+    with LIKE, which is case sensitive on MySQL as in Python but not on
+    SQLite."""
+
+    def closed(self) -> "UserQuerySet":
+        return self.filter(_closed())
+
+    def open(self) -> "UserQuerySet":
+        return self.exclude(_closed())
+
+    def hidden(self) -> "UserQuerySet":
+        return self.filter(noleginon=1)
 
 
 class UserData(models.Model):
@@ -17,6 +128,8 @@ class UserData(models.Model):
     noleginon = models.IntegerField(blank=True, null=True)
     advanced = models.IntegerField(blank=True, null=True)
 
+    objects = UserQuerySet.as_manager()
+
     def closed(self) -> bool:
         if self.firstname and not self.firstname.startswith("x-"):
             return False
@@ -64,6 +177,9 @@ class SessionData(models.Model):
     )
     # frame_path = models.TextField(db_column="frame path", blank=True, null=True)
 
+    joined: ClassVar[Tuple[str, ...]] = ("ref_userdata_user",)
+    objects = _SessionManager()
+
     def __str__(self) -> str:
         return self.name or "<no name>"
 
@@ -178,6 +294,11 @@ class CameraEMData(models.Model):
         db_column="SEQ|use frames", blank=True, null=True
     )
 
+    joined: ClassVar[Tuple[str, ...]] = (
+        "ref_sessiondata_session__ref_userdata_user",
+    )
+    objects = _CameraManager()
+
     def __str__(self) -> str:
         session = "<no session>"
         if s := self.ref_sessiondata_session:
@@ -267,6 +388,12 @@ class AcquisitionImageData(models.Model):
         db_column="SEQ|use frames", blank=True, null=True
     )
 
+    joined: ClassVar[Tuple[str, ...]] = (
+        "ref_sessiondata_session__ref_userdata_user",
+        "ref_cameraemdata_camera__ref_sessiondata_session__ref_userdata_user",
+    )
+    objects = _ImageManager()
+
     def __str__(self) -> str:
         return self.mrc_image or "<no mrc>"
 
@@ -0,0 +1,212 @@
+import datetime
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.db.models import Max
+
+from .models import AcquisitionImageData, SessionData
+
+
+class Usage:
+    "files and bytes under a session's image path, or summed over sessions"
+
+    __slots__ = ("files", "bytes", "missing", "errors")
+
+    def __init__(
+        self,
+        files: int = 0,
+        nbytes: int = 0,
+        missing: Optional[List[str]] = None,
+        errors: Optional[List[str]] = None,
+    ) -> None:
+        self.files = files
+        self.bytes = nbytes
+        # mrc images recorded in the database but not on disk
+        self.missing: List[str] = missing or []
+        # directories and files that could not be read, left out of the
+        # counts
+        self.errors: List[str] = errors or []
+
+    def add(self, other: "Usage") -> None:
+        self.files += other.files
+        self.bytes += other.bytes
+        self.missing.extend(other.missing)
+        self.errors.extend(other.errors)
+
+    def __str__(self) -> str:
+        return "%d files, %d bytes, %d missing, %d errors" % (
+            self.files,
+            self.bytes,
+            len(self.missing),
+            len(self.errors),
+        )
+
+
+def _walk(path: str) -> Tuple[int, int, Set[str], List[str]]:
+    """(files, bytes) under path, the names of its top level files and the
+    paths that could not be read.  Sessions are scanned while they are
+    written and cleaned up, so anything can vanish mid-walk; a path that
+    is gone is skipped and any other OSError is recorded."""
+    files = nbytes = 0
+    names: Set[str] = set()
+    errors: List[str] = []
+    todo = [path]
+    while todo:
+        d = todo.pop()
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            todo.append(e.path)
+                        elif e.is_file(follow_symlinks=False):
+                            n = e.stat(follow_symlinks=False).st_size
+                            files += 1
+                            nbytes += n
+                            if d == path:
+                                names.add(e.name)
+                    except FileNotFoundError:
+                        pass
+                    except OSError:
+                        errors.append(e.path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            errors.append(d)
+    return files, nbytes, names, errors
+
+
+def _scan(path: Optional[str], expected: List[str]) -> Usage:
+    if not path:
+        return Usage(missing=expected)
+    files, nbytes, names, errors = _walk(path)
+    missing = [os.path.join(path, n) for n in expected if n not in names]
+    if path in errors:
+        # nothing is known to be missing from a directory that can't be read
+        missing = []
+    return Usage(files, nbytes, missing, errors)
+
+
+class _Cache:
+    """usage of the quiet sessions, as json in one file replaced whole;
+    an entry holds as long as its session's last image has not changed"""
+
+    def __init__(self, path: Optional[str]) -> None:
+        self._path = path
+        self._entries: Dict[str, Any] = {}
+        if path is None:
+            return
+        try:
+            with open(path, encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+
+    def get(self, session: int, last: str) -> Optional[Usage]:
+        entry = self._entries.get(str(session))
+        if entry is None or entry["last"] != last:
+            return None
+        return Usage(entry["files"], entry["bytes"], entry["missing"])
+
+    def put(self, session: int, last: str, usage: Usage) -> None:
+        self._entries[str(session)] = {
+            "last": last,
+            "files": usage.files,
+            "bytes": usage.bytes,
+            "missing": usage.missing,
+        }
+
+    def save(self) -> None:
+        if self._path is None:
+            return
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self._path)), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self._path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def sessions(
+    ss: Optional[Iterable[SessionData]] = None,
+    workers: int = 16,
+    cache: Optional[str] = None,
+    quiet: float = 7 * 24 * 3600,
+    using: str = "default",
+) -> Dict[SessionData, Usage]:
+    """usage of every session in ss (all of them by default), scanning
+    workers image paths at a time.  With a cache file, sessions whose last
+    image is older than quiet seconds are only scanned once, unless their
+    scan hit errors.  Paths that cannot be read end up in Usage.errors
+    rather than failing the scan."""
+    images = AcquisitionImageData.objects.using(using)
+    if ss is None:
+        ss = SessionData.objects.using(using).all()
+    else:
+        ss = list(ss)
+        images = images.filter(ref_sessiondata_session__in=ss)
+    lasts: Dict[int, datetime.datetime] = dict(
+        images.values_list("ref_sessiondata_session")
+        .annotate(Max("def_timestamp"))
+        .order_by()
+    )
+    quiet_before = datetime.datetime.now(
+        datetime.timezone.utc
+    ) - datetime.timedelta(seconds=quiet)
+    c = _Cache(cache)
+    usage: Dict[SessionData, Usage] = {}
+    todo = []
+    for s in ss:
+        last = lasts.get(s.pk)
+        if last is not None and last < quiet_before:
+            if (u := c.get(s.pk, last.isoformat())) is not None:
+                usage[s] = u
+                continue
+        todo.append(s)
+    # the database is read here, a few sessions' worth of images per query,
+    # and the workers only touch the filesystem
+    chunk = 4 * workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for i in range(0, len(todo), chunk):
+                part = todo[i : i + chunk]
+                expected: Dict[int, List[str]] = {s.pk: [] for s in part}
+                for _, session, name in images.filter(
+                    ref_sessiondata_session__in=part, mrc_image__isnull=False
+                ).stream("ref_sessiondata_session", "mrc_image"):
+                    expected[session].append(name)
+                scans = pool.map(
+                    _scan,
+                    [s.image_path for s in part],
+                    [expected[s.pk] for s in part],
+                )
+                for s, u in zip(part, scans):
+                    usage[s] = u
+                    last = lasts.get(s.pk)
+                    # a scan that hit errors is tried again next time
+                    if (
+                        last is not None
+                        and last < quiet_before
+                        and not u.errors
+                    ):
+                        c.put(s.pk, last.isoformat(), u)
+        finally:
+            pool.shutdown(cancel_futures=True)
+    c.save()
+    return usage
+
+
+def users(usage: Dict[SessionData, Usage]) -> Dict[str, Usage]:
+    "sessions() summed per username; sessions without a user are left out"
+    total: Dict[str, Usage] = {}
+    for s, u in usage.items():
+        if (user := s.ref_userdata_user) is not None:
+            total.setdefault(user.username, Usage()).add(u)
+    return total
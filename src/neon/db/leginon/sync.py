@@ -0,0 +1,137 @@
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from django.db import models, transaction
+
+from ... import ldap
+from ...redmine import o
+from .models import UserData
+
+_EmgUser = Union[o.EmgUser, o.EmgUserSnapshot]
+_Changes = Dict[str, Tuple[object, object]]
+
+# the UserData columns kept in line with the directory and Redmine
+fields = ("firstname", "lastname", "email")
+
+
+class Plan:
+    """what sync() does, or would do, to UserData.
+
+    create are the new rows, update the (row, {field: (old, new)}) changes
+    and skipped the (username, reason) of the users left alone: emg-users
+    missing a field, disagreeing emg-users of the same ldap user and
+    values too long for their column, which are not truncated."""
+
+    def __init__(self) -> None:
+        self.create: List[UserData] = []
+        self.update: List[Tuple[UserData, _Changes]] = []
+        self.skipped: List[Tuple[str, str]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.create or self.update)
+
+    def report(self) -> str:
+        lines = []
+        for u in self.create:
+            lines.append(
+                f"create {u.username}: {u.firstname} {u.lastname}"
+                f" <{u.email}>"
+            )
+        for u, changes in self.update:
+            for f, (old, new) in changes.items():
+                lines.append(f"update {u.username}: {f} {old!r} -> {new!r}")
+        for username, reason in self.skipped:
+            lines.append(f"skip {username}: {reason}")
+        return "\n".join(lines)
+
+
+def _wanted(
+    user: ldap.User, emgusers: List[_EmgUser]
+) -> Tuple[Optional[Dict[str, Optional[str]]], str]:
+    '(column values, "") for a user, or (None, why not)'
+    rows = set()
+    for e in emgusers:
+        try:
+            row = (e.firstname, e.lastname, e.email or user.email)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            return None, f"{e}: {ex}"
+        rows.add(row)
+    if len(rows) > 1:
+        return None, "emg-users disagree: " + ", ".join(map(str, emgusers))
+    values: Dict[str, Optional[str]] = dict(zip(fields, rows.pop()))
+    values["username"] = user.username
+    for f, v in values.items():
+        field = UserData._meta.get_field(f)
+        assert isinstance(field, models.Field)
+        limit = field.max_length
+        if v is not None and limit is not None and len(v) > limit:
+            return None, f"{f} {v!r} is over {limit} characters"
+    return values, ""
+
+
+def plan(
+    users: Iterable[ldap.User],
+    emgusers: Iterable[_EmgUser],
+    using: str = "default",
+) -> Plan:
+    """the changes that bring UserData in line with the directory users that
+    have an open emg-user, against one read of the UserData table.  Closed
+    UserData rows are left to the account cleanup."""
+    by_ldap: Dict[str, List[_EmgUser]] = {}
+    for e in emgusers:
+        if not e.closed():
+            by_ldap.setdefault(e.ldap, []).append(e)
+    rows = {
+        u.username: u
+        for u in UserData.objects.using(using).only(
+            "username", "noleginon", *fields
+        )
+    }
+    p = Plan()
+    for user in users:
+        if user.username not in by_ldap:
+            continue
+        values, why = _wanted(user, by_ldap[user.username])
+        if values is None:
+            p.skipped.append((user.username, why))
+            continue
+        row = rows.get(user.username)
+        if row is None:
+            p.create.append(UserData(**values))
+            continue
+        if row.closed():
+            continue
+        changes: _Changes = {
+            f: (getattr(row, f), values[f])
+            for f in fields
+            if getattr(row, f) != values[f]
+        }
+        if changes:
+            for f, (_, new) in changes.items():
+                setattr(row, f, new)
+            p.update.append((row, changes))
+    return p
+
+
+def apply(p: Plan, batch: int = 500, using: str = "default") -> None:
+    "writes p in batch-row bulk queries, all in one transaction"
+    with transaction.atomic(using=using):
+        UserData.objects.using(using).bulk_create(p.create, batch_size=batch)
+        UserData.objects.using(using).bulk_update(
+            [row for row, _ in p.update], fields, batch_size=batch
+        )
+
+
+def sync(
+    users: Iterable[ldap.User],
+    emgusers: Iterable[_EmgUser],
+    dry_run: bool = False,
+    batch: int = 500,
+    using: str = "default",
+) -> Plan:
+    """plan() and, unless dry_run, apply(); e.g.
+    print(sync(conn.users(), redmine.emgusers(status="*"), dry_run=True).report())
+    """
+    p = plan(users, emgusers, using)
+    if not dry_run:
+        apply(p, batch, using)
+    return p
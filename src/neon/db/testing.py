@@ -0,0 +1,41 @@
+import contextlib
+from typing import Dict, Generator, Type
+
+from django.db import connections, models
+from django.test.utils import CaptureQueriesContext
+
+from .leginon import models as leginon
+
+
+@contextlib.contextmanager
+def assert_queries(
+    n: int, using: str = "default"
+) -> Generator[CaptureQueriesContext, None, None]:
+    "fails unless the block runs exactly n queries on database using"
+    with CaptureQueriesContext(connections[using]) as ctx:
+        yield ctx
+    if len(ctx) != n:
+        sql = "\n".join(q["sql"] for q in ctx.captured_queries)
+        raise AssertionError(f"{len(ctx)} queries, expected {n}:\n{sql}")
+
+
+# model -> queries to list the model's rows with str()
+listings: Dict[Type[models.Model], int] = {
+    leginon.UserData: 1,
+    leginon.SessionData: 1,
+    leginon.CameraEMData: 1,
+    leginon.AcquisitionImageData: 1,
+}
+
+
+# pylint: disable=protected-access
+def check_listings(limit: int = 100, using: str = "default") -> None:
+    """lists the first limit rows of each model in listings, following
+    every foreign key, and fails if that takes more queries than listed"""
+    for model, n in listings.items():
+        with assert_queries(n, using):
+            for row in model._default_manager.using(using)[:limit]:
+                str(row)
+                for f in model._meta.concrete_fields:
+                    if f.is_relation:
+                        getattr(row, f.name)
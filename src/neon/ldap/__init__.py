@@ -1 +1,2 @@
 from ._ldap import *
+from ._snapshot import *
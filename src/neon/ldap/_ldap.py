@@ -1,12 +1,48 @@
 import abc
-from typing import Any, Dict, Generator, Optional
+import contextlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
 import ldap3
-import ldap3.abstract.entry
+import ldap3.core.exceptions
 import ldap3.utils.conv
 
+from .. import policy as _policy
+from ..policy import Policy
+
+_paged = "1.2.840.113556.1.4.319"  # simple paged results control
+
+# uid initials searched together by Connection.users_sharded()
+_shards = ("ab", "cd", "ef", "gh", "ijk", "lm", "nop", "qrs", "tuv", "wxyz")
+
+
+def _transient(e: Exception) -> bool:
+    return isinstance(
+        e,
+        (
+            ldap3.core.exceptions.LDAPCommunicationError,
+            ldap3.core.exceptions.LDAPResponseTimeoutError,
+            ldap3.core.exceptions.LDAPBusyResult,
+            ldap3.core.exceptions.LDAPUnavailableResult,
+        ),
+    )
+
 
 class User(abc.ABC):
+    __slots__ = ()
     attributes = ["uid", "mail", "gidNumber"]
 
     @property
@@ -23,78 +59,335 @@ class User(abc.ABC):
         return "%s: %s" % (self.username, self.email)
 
 
-class DataUser(User):
-    def __init__(self, data: Dict[str, Any]) -> None:
-        self._data = data
-        self._attributes = data["attributes"]
+class Record(User):
+    "a user whose attributes have been pulled out of the search result"
 
-    @property
-    def username(self) -> str:
-        xs = self._attributes["uid"]
-        assert len(xs) == 1
-        x = xs[0]
-        assert isinstance(x, str)
-        return x
-
-    @property
-    def email(self) -> Optional[str]:
-        xs = self._attributes["mail"]
-        if len(xs) == 0:
-            return None
-        assert len(xs) == 1
-        x = xs[0]
-        assert isinstance(x, str)
-        return x
+    __slots__ = ("_username", "_email", "_gid")
 
+    def __init__(
+        self, username: str, email: Optional[str], gid: Optional[int]
+    ) -> None:
+        self._username = username
+        self._email = email
+        self._gid = gid
 
-class EntryUser(User):
-    def __init__(self, entry: ldap3.abstract.entry.Entry) -> None:
-        self._entry = entry
+    @classmethod
+    def from_data(cls, data: Dict[str, Any]) -> "Record":
+        "checks and pulls out the attributes of a search result entry once"
+        attributes = data["attributes"]
+        uid = attributes["uid"]
+        if isinstance(uid, list):
+            assert len(uid) == 1
+            uid = uid[0]
+        assert isinstance(uid, str)
+        mail = attributes.get("mail")
+        if isinstance(mail, list):
+            assert len(mail) <= 1
+            mail = mail[0] if mail else None
+        assert mail is None or isinstance(mail, str)
+        gid = attributes.get("gidNumber")
+        if isinstance(gid, list):
+            gid = gid[0] if gid else None
+        return cls(uid, mail, None if gid is None else int(gid))
 
     @property
     def username(self) -> str:
-        x = self._entry.uid.value
-        assert isinstance(x, str)
-        return x
+        return self._username
 
     @property
     def email(self) -> Optional[str]:
-        x = self._entry.mail.value
-        assert isinstance(x, str)
-        return x
+        return self._email
+
+    @property
+    def gid(self) -> Optional[int]:
+        return self._gid
 
 
 class Connection:
-    def __init__(self, cfg: Dict[str, str]) -> None:
-        self._conn = ldap3.Connection(
-            cfg["url"],
-            cfg["bind_dn"],
-            cfg["key"],
-            auto_bind=True,
-        )
+    """a pool of directory connections, safe to share between threads.
+
+    Connections are opened and bound on first use and every search gets
+    one to itself, so results never go through shared state.  Up to
+    pool_size idle connections are kept for reuse; when all of them are
+    busy another is opened and closed again afterwards.  An idle
+    connection is dropped once it has been idle for max_idle seconds
+    (servers and firewalls time idle ones out), one that turns out to be
+    closed or unbound is rebound, and one that a search failed on is
+    dropped.  A search whose connection was dropped under it is sent once
+    more on a new socket, unless it is a later page of a paged search."""
+
+    def __init__(
+        self,
+        cfg: Dict[str, str],
+        policy: Optional[Policy] = None,
+        pool_size: int = 4,
+        max_idle: float = 300,
+    ) -> None:
         self._cfg = cfg
+        self._policy = policy
+        self._pool_size = pool_size
+        self._max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[ldap3.Connection, float]] = []
 
-    def users(self) -> Generator[User, None, None]:
-        entries = self._conn.extend.standard.paged_search(
-            self._cfg["search.users"],
-            "(objectClass=posixAccount)",
-            attributes=User.attributes,
-            paged_size=1000,
+    def _connect(self) -> ldap3.Connection:
+        return ldap3.Connection(
+            self._cfg["url"],
+            self._cfg["bind_dn"],
+            self._cfg["key"],
+            auto_bind=ldap3.AUTO_BIND_NONE,
         )
-        for e in entries:
-            yield DataUser(e)
 
-    def user_for_uid(self, uid: str) -> Optional[User]:
+    @contextlib.contextmanager
+    def _checkout(self) -> Generator[ldap3.Connection, None, None]:
+        conn = None
+        stale = []
+        with self._lock:
+            now = time.monotonic()
+            while self._idle:
+                c, since = self._idle.pop()  # most recently used first
+                if now - since < self._max_idle and not c.closed:
+                    conn = c
+                    break
+                stale.append(c)
+        for c in stale:
+            c.unbind()
+        if conn is None:
+            conn = self._connect()
+        try:
+            yield conn
+        except BaseException:
+            conn.unbind()
+            raise
+        with self._lock:
+            if len(self._idle) < self._pool_size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.unbind()
+
+    def close(self) -> None:
+        "unbinds the idle connections; busy ones are unbound when returned"
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._pool_size = 0
+        for conn, _ in idle:
+            conn.unbind()
+
+    def _search(
+        self,
+        conn: ldap3.Connection,
+        search_filter: str,
+        attributes: Optional[List[str]] = None,
+        **kw: Any,
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """(entries, result) of a users search on conn, under the policy;
+        a dropped connection is rebound, unless the search is a later page
+        of a paged search"""
+
+        def bind() -> None:
+            if kw.get("paged_cookie"):
+                # the cookie was only good on the connection that's gone
+                raise ldap3.core.exceptions.LDAPException(
+                    "connection lost during a paged search"
+                )
+            # bind() returns False on bad credentials rather than
+            # raising, which would leave an anonymous search
+            if not conn.bind():
+                raise ldap3.core.exceptions.LDAPBindError(conn.result)
+
+        def search() -> None:
+            conn.search(
+                self._cfg["search.users"],
+                search_filter,
+                attributes=attributes or User.attributes,
+                **kw,
+            )
+
+        def attempt() -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+            if conn.closed or not conn.bound:
+                bind()
+            try:
+                search()
+            except ldap3.core.exceptions.LDAPCommunicationError:
+                # a pooled connection the server or a firewall dropped
+                # while idle still looks open until it is used; it gets
+                # one more go on a new socket, with or without a policy
+                with contextlib.suppress(ldap3.core.exceptions.LDAPException):
+                    conn.unbind()
+                bind()
+                search()
+            result = conn.result
+            # anything but success (e.g. a rejected paged cookie) would
+            # otherwise look like the last page
+            if result["result"] != 0:
+                raise ldap3.core.exceptions.LDAPOperationResult(
+                    result=result["result"],
+                    description=result["description"],
+                    message=result["message"],
+                )
+            entries = [
+                e for e in conn.response or [] if e["type"] == "searchResEntry"
+            ]
+            return entries, result
+
+        return _policy.run(self._policy, _transient, attempt)
+
+    def _paged(
+        self, search_filter: str, attributes: Optional[List[str]] = None
+    ) -> Generator[Dict[str, Any], None, None]:
+        # the paged results cookie is only good on the connection it came
+        # from, so the connection is held until the last page
+        with self._checkout() as conn:
+            cookie = None
+            while True:
+                # one search per page so a failed page is retried on its own,
+                # as long as its connection is still up
+                page, result = self._search(
+                    conn,
+                    search_filter,
+                    attributes,
+                    paged_size=1000,
+                    paged_cookie=cookie,
+                )
+                controls = result.get("controls") or {}
+                cookie = (
+                    controls.get(_paged, {}).get("value", {}).get("cookie")
+                )
+                yield from page
+                if not cookie:
+                    break
+
+    def users(self) -> Generator[Record, None, None]:
+        for e in self._paged("(objectClass=posixAccount)"):
+            yield Record.from_data(e)
+
+    def users_sharded(
+        self, shards: Sequence[str] = _shards
+    ) -> Generator[Record, None, None]:
+        """users() split into one paged search per group of uid initials,
+        each on its own connection and thread; one more search covers uids
+        starting with anything else.  Users come in no particular order.
+
+        That last search is an AND of (!(uid=x*)) terms, which no index
+        can answer, so the server walks the whole subtree for it; it only
+        pays off when per-page round trips cost more than that scan (see
+        sbin/bench-ldap-shards)."""
+        filters = [
+            "(|" + "".join(f"(uid={c}*)" for c in group) + ")"
+            for group in shards
+        ]
+        others = "".join(f"(!(uid={c}*))" for c in "".join(shards))
+        filters.append(f"(&{others})")
+        results: queue.Queue[Any] = queue.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def crawl(search_filter: str) -> None:
+            try:
+                for e in self._paged(
+                    f"(&(objectClass=posixAccount){search_filter})"
+                ):
+                    if stop.is_set():
+                        return
+                    results.put(e)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                results.put(e)
+            finally:
+                results.put(done)
+
+        with ThreadPoolExecutor(max_workers=len(filters)) as pool:
+            try:
+                for f in filters:
+                    pool.submit(crawl, f)
+                running = len(filters)
+                while running:
+                    x = results.get()
+                    if x is done:
+                        running -= 1
+                    elif isinstance(x, Exception):
+                        raise x
+                    else:
+                        yield Record.from_data(x)
+            finally:
+                stop.set()
+
+    def users_modified_since(
+        self, stamp: Optional[str] = None
+    ) -> Generator[Tuple[Record, str], None, None]:
+        """(user, modifyTimestamp) of the users modified at or after stamp
+        (generalized time, e.g. 20250101000000Z), or of every user"""
+        search_filter = "(objectClass=posixAccount)"
+        if stamp:
+            stamp = ldap3.utils.conv.escape_filter_chars(stamp)
+            search_filter = f"(&{search_filter}(modifyTimestamp>={stamp}))"
+        attributes = User.attributes + ["modifyTimestamp"]
+        for e in self._paged(search_filter, attributes):
+            raw = e["raw_attributes"].get("modifyTimestamp") or [b""]
+            yield Record.from_data(e), raw[0].decode()
+
+    def users_for_uids(
+        self, uids: Iterable[str], chunk: int = 100, workers: int = 1
+    ) -> Dict[str, Optional[Record]]:
+        """uid -> Record for every uid asked for, None for the ones not in
+        the directory; chunk uids are looked up per (|(uid=..)(uid=..))
+        search, workers searches at a time"""
+        found: Dict[str, Optional[Record]] = dict.fromkeys(uids)
+        # the directory matches uids regardless of case
+        asked: Dict[str, List[str]] = {}
+        for uid in found:
+            asked.setdefault(uid.lower(), []).append(uid)
+        todo = list(found)
+
+        def lookup(uids: List[str]) -> List[Record]:
+            terms = "".join(
+                f"(uid={ldap3.utils.conv.escape_filter_chars(uid)})"
+                for uid in uids
+            )
+            search_filter = f"(&(objectClass=posixAccount)(|{terms}))"
+            return [Record.from_data(e) for e in self._paged(search_filter)]
+
+        chunks = [todo[i : i + chunk] for i in range(0, len(todo), chunk)]
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            try:
+                for users in pool.map(lookup, chunks):
+                    for user in users:
+                        for uid in asked.get(user.username.lower(), []):
+                            found[uid] = user
+            finally:
+                pool.shutdown(cancel_futures=True)
+        return found
+
+    def user_for_uid(self, uid: str) -> Optional[Record]:
         uid = ldap3.utils.conv.escape_filter_chars(uid)
-        user = self._conn.search(
-            self._cfg["search.users"],
-            f"(&(objectClass=posixAccount)(uid={uid}))",
-            attributes=User.attributes,
-        )
-        if not user:
+        with self._checkout() as conn:
+            entries, _ = self._search(
+                conn, f"(&(objectClass=posixAccount)(uid={uid}))"
+            )
+        if not entries:
             return None
-        assert len(self._conn.entries) == 1
-        return EntryUser(self._conn.entries[0])
+        assert len(entries) == 1
+        return Record.from_data(entries[0])
+
+
+_U = TypeVar("_U", bound=User)
+
+
+def by_uid(users: Iterable[_U]) -> Dict[str, _U]:
+    "username -> user, e.g. by_uid(conn.users())"
+    index: Dict[str, _U] = {}
+    for user in users:
+        assert user.username not in index
+        index[user.username] = user
+    return index
+
+
+def by_email(users: Iterable[_U]) -> Dict[str, List[_U]]:
+    "email -> the users with that email; users without one are left out"
+    index: Dict[str, List[_U]] = {}
+    for user in users:
+        if user.email is not None:
+            index.setdefault(user.email, []).append(user)
+    return index
 
 
-__all__ = ["Connection"]
+__all__ = ["Connection", "Record", "User", "by_email", "by_uid"]
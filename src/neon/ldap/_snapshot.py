@@ -0,0 +1,129 @@
+import sqlite3
+import threading
+import time
+from typing import Generator, List, Optional, Set
+
+from ._ldap import Connection, Record, User
+
+_schema = """
+CREATE TABLE IF NOT EXISTS user (
+    uid TEXT PRIMARY KEY,
+    mail TEXT,
+    gid INTEGER
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class Snapshot:
+    """local sqlite copy of the directory's users (uid, mail, gidNumber).
+
+    refresh() only asks for the entries whose modifyTimestamp is at or past
+    the stored high-water mark.  Deleted entries are only noticed by a full
+    pass, which refresh() makes once the last one is older than
+    full_interval seconds.  Each thread gets its own connection to the
+    database file at path, so path must be a file; close() closes them
+    all."""
+
+    def __init__(
+        self, conn: Connection, path: str, full_interval: float = 24 * 3600
+    ) -> None:
+        if path in ("", ":memory:"):
+            # every connection would get a database of its own
+            raise Exception(f"Snapshot needs a database file, not [{path}]")
+        self._conn = conn
+        self._full_interval = full_interval
+        self._path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._dbs: List[sqlite3.Connection] = []
+        # readers go on while refresh() writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_schema)
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        db: Optional[sqlite3.Connection] = getattr(self._local, "db", None)
+        if db is None:
+            # only ever used on this thread, but close() may run on another
+            db = sqlite3.connect(
+                self._path, timeout=60, check_same_thread=False
+            )
+            with self._lock:
+                self._dbs.append(db)
+            self._local.db = db
+        return db
+
+    def close(self) -> None:
+        "closes every thread's connection"
+        with self._lock:
+            dbs, self._dbs = self._dbs, []
+        for db in dbs:
+            db.close()
+        self._local = threading.local()
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else str(row[0])
+
+    def hwm(self) -> Optional[str]:
+        return self._meta("hwm")
+
+    def refresh(self, full: bool = False) -> int:
+        "returns the number of entries read from the directory"
+        last_full = float(self._meta("full") or 0)
+        full = full or time.time() - last_full >= self._full_interval
+        hwm = None if full else self.hwm()
+        n = 0
+        seen: Set[str] = set()
+        with self._db:
+            # the listing raises unless the search completed, and rolls
+            # the transaction back
+            for user, stamp in self._conn.users_modified_since(hwm):
+                self._db.execute(
+                    "INSERT OR REPLACE INTO user (uid, mail, gid) "
+                    "VALUES (?, ?, ?)",
+                    (user.username, user.email, user.gid),
+                )
+                if full:
+                    seen.add(user.username)
+                # generalized time in UTC sorts as text
+                hwm = max(hwm or "", stamp) or None
+                n += 1
+            if hwm:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('hwm', ?)", (hwm,)
+                )
+            if full:
+                # only users a complete listing did not return are dropped
+                gone = [
+                    (uid,)
+                    for (uid,) in self._db.execute("SELECT uid FROM user")
+                    if uid not in seen
+                ]
+                self._db.executemany("DELETE FROM user WHERE uid = ?", gone)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('full', ?)",
+                    (str(time.time()),),
+                )
+        return n
+
+    def users(self) -> Generator[User, None, None]:
+        for row in self._db.execute("SELECT uid, mail, gid FROM user"):
+            yield Record(*row)
+
+    def user_for_uid(self, uid: str) -> Optional[User]:
+        # the directory matches uids regardless of case
+        row = self._db.execute(
+            "SELECT uid, mail, gid FROM user WHERE uid = ? COLLATE NOCASE",
+            (uid,),
+        ).fetchone()
+        return None if row is None else Record(*row)
+
+
+__all__ = ["Snapshot"]
@@ -0,0 +1,129 @@
+import itertools
+import random
+import threading
+import time
+from typing import Any, Callable, Optional, TypeVar
+
+_R = TypeVar("_R")
+
+
+class Policy:
+    """rate limit, retries and adaptive concurrency for calls to a backend;
+    one Policy is shared by every thread talking to that backend.
+
+    A token bucket admits at most rate calls per second, in bursts of up to
+    burst.  A call failing with an error the backend's connection deems
+    transient is retried up to retries times, after sleeping a random time
+    under backoff * 2**attempt (capped at max_backoff).  The number of calls
+    in flight starts at concurrency: it grows by one after as many fast
+    calls (latency <= target seconds), shrinks by one after a slow call and
+    halves after a transient error."""
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: int = 1,
+        retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 30,
+        concurrency: int = 4,
+        max_concurrency: int = 32,
+        target: float = 1,
+    ) -> None:
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._stamp = time.monotonic()
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._limit = max(1, concurrency)
+        self._max = max(self._limit, max_concurrency)
+        self._target = target
+        self._active = 0
+        self._fast = 0
+        self._cond = threading.Condition()
+
+    @property
+    def concurrency(self) -> int:
+        return self._limit
+
+    def _acquire(self) -> None:
+        with self._cond:
+            while self._active >= self._limit:
+                self._cond.wait()
+            self._active += 1
+        if self._rate is None:
+            return
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._burst,
+                    self._tokens + (now - self._stamp) * self._rate,
+                )
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def _release(self, latency: Optional[float]) -> None:
+        "latency is None after a transient error"
+        with self._cond:
+            self._active -= 1
+            if latency is None:
+                self._limit = max(1, self._limit // 2)
+                self._fast = 0
+            elif latency > self._target:
+                self._limit = max(1, self._limit - 1)
+                self._fast = 0
+            else:
+                self._fast += 1
+                if self._fast >= self._limit:
+                    self._limit = min(self._max, self._limit + 1)
+                    self._fast = 0
+            self._cond.notify_all()
+
+    def run(
+        self,
+        transient: Callable[[Exception], bool],
+        fn: Callable[..., _R],
+        *args: Any,
+        **kw: Any,
+    ) -> _R:
+        for attempt in itertools.count():
+            self._acquire()
+            start = time.monotonic()
+            try:
+                r = fn(*args, **kw)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                if not transient(e):
+                    self._release(time.monotonic() - start)
+                    raise
+                self._release(None)
+                if attempt >= self._retries:
+                    raise
+                delay = min(self._max_backoff, self._backoff * 2**attempt)
+                time.sleep(random.uniform(0, delay))
+                continue
+            except BaseException:
+                self._release(time.monotonic() - start)
+                raise
+            self._release(time.monotonic() - start)
+            return r
+        assert False, "unreachable"
+
+
+def run(
+    policy: Optional[Policy],
+    transient: Callable[[Exception], bool],
+    fn: Callable[..., _R],
+    *args: Any,
+    **kw: Any,
+) -> _R:
+    "fn(*args, **kw) under policy, or called directly if there is none"
+    if policy is None:
+        return fn(*args, **kw)
+    return policy.run(transient, fn, *args, **kw)
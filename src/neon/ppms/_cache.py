@@ -0,0 +1,101 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Set, Tuple
+
+# entries are pickled: only point this at a directory you trust
+
+
+class DiskCache:
+    """PUMAPI responses under a directory, one file per endpoint and key.
+
+    An entry younger than its endpoint's ttl is served as is, one younger
+    than ttl + stale is served while a background thread refreshes it, and
+    anything older (or missing) is fetched before returning.  Entries are
+    written to a temporary file and renamed into place, so processes
+    sharing the directory never see a partial entry.  A KeyError raised by
+    fetch is cached like a value, and raised anew on every hit.  Background
+    refreshes run at most refresh_workers at a time, on threads that keep
+    the interpreter from exiting until close() cancels the queued ones."""
+
+    def __init__(
+        self,
+        path: str,
+        ttls: Dict[str, float],
+        stale: float,
+        refresh_workers: int = 2,
+    ) -> None:
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._ttls = ttls
+        self._stale = stale
+        self._lock = threading.Lock()
+        self._refreshing: Set[str] = set()
+        self._pool = ThreadPoolExecutor(
+            max_workers=refresh_workers, thread_name_prefix="DiskCache"
+        )
+
+    def _file(self, endpoint: str, key: str) -> str:
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self._path, f"{endpoint}-{digest}.pickle")
+
+    def get(self, endpoint: str, key: str, fetch: Callable[[], Any]) -> Any:
+        fn = self._file(endpoint, key)
+        try:
+            age = time.time() - os.stat(fn).st_mtime
+            with open(fn, "rb") as f:
+                entry: Tuple[bool, Any] = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            entry = self._fetch(fn, fetch)
+        else:
+            ttl = self._ttls[endpoint]
+            if age >= ttl + self._stale:
+                entry = self._fetch(fn, fetch)
+            elif age >= ttl:
+                self._revalidate(fn, fetch)
+        ok, value = entry
+        if not ok:
+            # not the cached instance, which would collect the traceback of
+            # every raise
+            raise KeyError(*value.args)
+        return value
+
+    def close(self) -> None:
+        "drops the queued refreshes; one already running is left to finish"
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _fetch(self, fn: str, fetch: Callable[[], Any]) -> Tuple[bool, Any]:
+        try:
+            entry: Tuple[bool, Any] = (True, fetch())
+        except KeyError as e:
+            entry = (False, e)
+        fd, tmp = tempfile.mkstemp(dir=self._path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(entry, f)
+            os.replace(tmp, fn)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return entry
+
+    def _revalidate(self, fn: str, fetch: Callable[[], Any]) -> None:
+        with self._lock:
+            if fn in self._refreshing:
+                return
+            self._refreshing.add(fn)
+
+        def refresh() -> None:
+            try:
+                self._fetch(fn, fetch)
+            except Exception:  # pylint: disable=broad-exception-caught
+                pass  # the stale entry stays until the next attempt
+            finally:
+                with self._lock:
+                    self._refreshing.discard(fn)
+
+        self._pool.submit(refresh)
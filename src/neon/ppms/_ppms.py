@@ -1,7 +1,30 @@
-from typing import Dict, List, Optional, cast
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    cast,
+)
 
 import pyppms
 import pyppms.user
+import requests
+import requests.exceptions
+
+from .. import policy as _policy
+from ..policy import Policy
+from ._cache import DiskCache
+
+_T = TypeVar("_T")
 
 
 class Group:
@@ -36,15 +59,172 @@ class Group:
         return f"[{self.name}|{self.pi_email}]"
 
 
+def _transient(e: Exception) -> bool:
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and (
+            e.response.status_code == 429 or e.response.status_code >= 500
+        )
+    # pyppms raises ConnectionError itself, without a request, for failed
+    # authentication and unauthorized actions: those are not retried
+    return (
+        isinstance(
+            e,
+            (requests.exceptions.ConnectionError, requests.exceptions.Timeout),
+        )
+        and e.request is not None
+    )
+
+
+class _PpmsConnection(pyppms.PpmsConnection):  # type: ignore[misc]
+    "runs every PUMAPI request under a Policy"
+
+    def __init__(self, url: str, key: str, policy: Optional[Policy]) -> None:
+        self._policy = policy
+        super().__init__(url, key)
+
+    # pylint: disable=dangerous-default-value
+    def request(
+        self,
+        action: str,
+        parameters: Dict[str, Any] = {},
+        skip_cache: bool = False,
+    ) -> requests.Response:
+        def attempt() -> requests.Response:
+            r = super(_PpmsConnection, self).request(
+                action, parameters, skip_cache
+            )
+            # pyppms doesn't look at the status code
+            if r.status_code == 429 or r.status_code >= 500:
+                r.raise_for_status()
+            return cast(requests.Response, r)
+
+        return _policy.run(self._policy, _transient, attempt)
+
+
+class _GroupCache:
+    """gid -> Group with a ttl and lru eviction; a None entry records a
+    group ppms doesn't know"""
+
+    def __init__(self, ttl: float, size: int) -> None:
+        self._ttl = ttl
+        self._size = size
+        self._data: OrderedDict[str, Tuple[float, Optional[Group]]]
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, gid: str) -> Tuple[bool, Optional[Group]]:
+        "(hit, group)"
+        with self._lock:
+            if (x := self._data.get(gid)) is None:
+                return False, None
+            if time.monotonic() - x[0] >= self._ttl:
+                del self._data[gid]
+                return False, None
+            self._data.move_to_end(gid)
+            return True, x[1]
+
+    def put(self, gid: str, g: Optional[Group]) -> None:
+        with self._lock:
+            self._data[gid] = (time.monotonic(), g)
+            self._data.move_to_end(gid)
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def grow(self, size: int) -> None:
+        with self._lock:
+            self._size = max(self._size, size)
+
+
 class Connection:
-    def __init__(self, url: str, key: str) -> None:
-        self._conn = pyppms.PpmsConnection(url, key)
+    """with a group_ttl, groups (and missing groups) are cached in memory
+    for that many seconds, keeping the group_cache_size most recently used;
+    prefetch_groups() turns that cache on if group_ttl didn't.
+
+    With a cache_dir, get_group/get_group_users/get_groups responses are
+    also cached on disk (see DiskCache), shared by every process using the
+    directory; cache_ttls overrides the per-endpoint ttls in seconds.  Call
+    close() when done so that queued refreshes don't hold up exit."""
+
+    cache_ttls: Dict[str, float] = {
+        "group": 24 * 3600,
+        "group_users": 24 * 3600,
+        "groups": 3600,
+    }
+
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        policy: Optional[Policy] = None,
+        group_ttl: Optional[float] = None,
+        group_cache_size: int = 4096,
+        cache_dir: Optional[str] = None,
+        cache_ttls: Optional[Dict[str, float]] = None,
+        cache_stale: float = 24 * 3600,
+    ) -> None:
+        self._conn = _PpmsConnection(url, key, policy)
+        self._group_cache_size = group_cache_size
+        self._groups = (
+            None
+            if group_ttl is None
+            else _GroupCache(group_ttl, group_cache_size)
+        )
+        self._disk = None
+        if cache_dir:
+            self._disk = DiskCache(
+                cache_dir,
+                dict(Connection.cache_ttls, **(cache_ttls or {})),
+                cache_stale,
+            )
+
+    def close(self) -> None:
+        "cancels the disk cache's queued refreshes, see DiskCache.close()"
+        if self._disk is not None:
+            self._disk.close()
+
+    def _cached(self, endpoint: str, key: str, fetch: Callable[[], _T]) -> _T:
+        if self._disk is None:
+            return fetch()
+        return cast(_T, self._disk.get(endpoint, key, fetch))
 
     def try_group(self, gid: str) -> Optional[Group]:
+        if self._groups is not None:
+            hit, g = self._groups.get(gid)
+            if hit:
+                return g
         try:
-            return Group(self._conn.get_group(gid))
+            g = Group(
+                self._cached("group", gid, lambda: self._conn.get_group(gid))
+            )
         except KeyError:
-            return None
+            g = None
+        if self._groups is not None:
+            self._groups.put(gid, g)
+        return g
+
+    def prefetch_groups(
+        self, workers: int = 8, ttl: float = 3600
+    ) -> Dict[str, Optional[Group]]:
+        """every group in groups(), fetched on workers threads into the
+        in-memory group cache.  Without a group_ttl the cache is set up here,
+        keeping groups for ttl seconds; either way it is grown to hold every
+        group, so the later ones don't evict the first."""
+        gids = self.groups()
+        size = max(self._group_cache_size, len(gids))
+        if self._groups is None:
+            self._groups = _GroupCache(ttl, size)
+        else:
+            self._groups.grow(size)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(gids, pool.map(self.try_group, gids)))
+
+    def clear_groups(self) -> None:
+        if self._groups is not None:
+            self._groups.clear()
 
     def group(self, gid: str) -> Group:
         if (g := self.try_group(gid)) is None:
@@ -52,10 +232,62 @@ class Connection:
         return g
 
     def groups(self) -> List[str]:
-        return cast(List[str], self._conn.get_groups())
+        return cast(
+            List[str], self._cached("groups", "", self._conn.get_groups)
+        )
 
     def users_for_group(self, gid: str) -> List[pyppms.user.PpmsUser]:
-        return cast(List[pyppms.user.PpmsUser], self._conn.get_group_users(gid))
+        return cast(
+            List[pyppms.user.PpmsUser],
+            self._cached(
+                "group_users", gid, lambda: self._conn.get_group_users(gid)
+            ),
+        )
+
+    def users_for_groups(
+        self,
+        gids: Optional[Iterable[str]] = None,
+        workers: int = 8,
+        retries: int = 2,
+    ) -> Generator[Tuple[str, List[pyppms.user.PpmsUser]], None, None]:
+        """(gid, members) of every gid (all of groups() by default), yielded
+        as each group completes on workers threads.  A failed group is
+        resubmitted up to retries times without holding up the others; the
+        groups still failing after that are raised once the rest are done."""
+        attempts: Dict[str, int] = {}
+        failed: Dict[str, BaseException] = {}
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {
+                pool.submit(self.users_for_group, gid): gid
+                for gid in (self.groups() if gids is None else gids)
+            }
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for f in done:
+                    gid = futures.pop(f)
+                    if (e := f.exception()) is None:
+                        yield gid, f.result()
+                    elif attempts.get(gid, 0) < retries:
+                        attempts[gid] = attempts.get(gid, 0) + 1
+                        futures[pool.submit(self.users_for_group, gid)] = gid
+                    else:
+                        failed[gid] = e
+        finally:
+            pool.shutdown(cancel_futures=True)
+        if failed:
+            raise Exception(
+                f"cannot list the members of groups {sorted(failed)}"
+            ) from next(iter(failed.values()))
+
+    def group_members(
+        self,
+        gids: Optional[Iterable[str]] = None,
+        workers: int = 8,
+        retries: int = 2,
+    ) -> Dict[str, List[pyppms.user.PpmsUser]]:
+        "gid -> members map, see users_for_groups()"
+        return dict(self.users_for_groups(gids, workers, retries))
 
 
 __all__ = ["Group", "Connection"]
@@ -1,2 +1,5 @@
 from . import o
+from ._aio import *
 from ._conn import *
+from ._index import *
+from ._mirror import *
@@ -0,0 +1,324 @@
+import asyncio
+import collections
+import json
+import uuid
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+import httpx
+import redminelib
+import redminelib.exceptions
+from redminelib.resources.standard import Issue as RedmineIssue
+
+from . import _fd, _u, o
+from ._conn import _checked, _merge, _unfilterable
+
+_R = TypeVar("_R")
+
+
+def _raise_for(status: int, data: bytes) -> None:
+    "same exceptions as python-redmine raises for the status"
+    if status in (200, 201, 204):
+        return
+    if status == 401:
+        raise redminelib.exceptions.AuthError
+    if status == 403:
+        raise redminelib.exceptions.ForbiddenError
+    if status == 404:
+        raise redminelib.exceptions.ResourceNotFoundError
+    if status == 409:
+        raise redminelib.exceptions.ConflictError
+    if status == 413:
+        raise redminelib.exceptions.RequestEntityTooLargeError
+    if status == 422:
+        errors = json.loads(data).get("errors", [])
+        raise redminelib.exceptions.ValidationError(", ".join(errors))
+    if status == 500:
+        raise redminelib.exceptions.ServerError
+    raise redminelib.exceptions.UnknownError(status)
+
+
+class AsyncConnection:
+    """asyncio counterpart of Connection: same methods and o objects, paged
+    methods are async generators and at most concurrency requests run at a
+    time.  Connecting, and each read or write, gives up after timeout
+    seconds with an httpx.TimeoutException.  Call aclose() when done."""
+
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        concurrency: int = 8,
+        timeout: Optional[float] = 60,
+    ) -> None:
+        self._url = url
+        self._concurrency = concurrency
+        # requests wait for a free connection rather than open more; proxies
+        # come from the environment, as they do for requests
+        self._http = httpx.AsyncClient(
+            base_url=url.rstrip("/"),
+            headers={"X-Redmine-API-Key": key, "Accept": "application/json"},
+            timeout=httpx.Timeout(timeout, pool=None),
+            limits=httpx.Limits(
+                max_connections=concurrency,
+                max_keepalive_connections=concurrency,
+            ),
+            follow_redirects=True,
+        )
+        # only used to build resources; it never makes a request
+        self._redmine = redminelib.Redmine(url, key=key)
+        self._filterable: Dict[Tuple[str, _fd.cf], bool] = {}
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    async def _json(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        body: Optional[Dict[str, Any]] = None,
+    ) -> Any:
+        r = await self._http.request(method, path, params=params, json=body)
+        _raise_for(r.status_code, r.content)
+        return json.loads(r.content) if r.content.strip() else None
+
+    def resource(self, raw: Dict[str, Any]) -> RedmineIssue:
+        return self._redmine.issue.to_resource(raw)
+
+    async def get(self, redmine_id: int) -> RedmineIssue:
+        data = await self._json("GET", f"/issues/{redmine_id}.json")
+        return self.resource(data["issue"])
+
+    async def _page(
+        self, params: Dict[str, Any]
+    ) -> Tuple[List[RedmineIssue], int]:
+        data = await self._json("GET", "/issues.json", params)
+        issues = [self.resource(raw) for raw in data["issues"]]
+        return issues, int(data.get("total_count", len(issues)))
+
+    async def _filter(self, **params: Any) -> List[RedmineIssue]:
+        "every issue matching params, as Connection's unpaged filter()"
+        params = dict(params, limit=100, offset=0)
+        issues, total = await self._page(params)
+        pages = await _all(
+            self._page(dict(params, offset=offset))
+            for offset in range(100, total, 100)
+        )
+        for page, _ in pages:
+            issues.extend(page)
+        return issues
+
+    async def issues(
+        self,
+        project_id: str,
+        updated_on: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = 25,
+    ) -> AsyncGenerator[RedmineIssue, None]:
+        """pages after the first are requested concurrently, up to
+        concurrency pages ahead of the one being yielded; issues are yielded
+        in offset order"""
+        limit = min(limit, 100)  # redmine caps limit at 100
+        params: Dict[str, Any] = {
+            "project_id": project_id,
+            "limit": limit,
+            "offset": 0,
+        }
+        if updated_on:
+            params["updated_on"] = ">=" + updated_on
+        if status:
+            params["status_id"] = status
+        issues, total = await self._page(params)
+        for issue in issues:
+            yield issue
+        if len(issues) < limit:
+            return
+        offsets = range(limit, total, limit)
+        todo = iter(offsets)
+        window: Deque[asyncio.Task[Tuple[List[RedmineIssue], int]]]
+        window = collections.deque()
+        try:
+            while True:
+                while len(window) < self._concurrency:
+                    if (offset := next(todo, None)) is None:
+                        break
+                    page = self._page(dict(params, offset=offset))
+                    window.append(asyncio.ensure_future(page))
+                if not window:
+                    break
+                for issue in (await window.popleft())[0]:
+                    yield issue
+        finally:
+            # don't leave pages running, or failing unseen, if the caller
+            # stops early or a page fails
+            await _cancel(window)
+        # pick up issues created after total_count was read
+        params["offset"] = limit * (len(offsets) + 1)
+        while True:
+            issues, _ = await self._page(params)
+            if not issues:
+                break
+            for issue in issues:
+                yield issue
+            params["offset"] += limit
+
+    async def emgusers(self, **kw: Any) -> AsyncGenerator[o.EmgUser, None]:
+        async for issue in self.issues(_u.project.EmgUsers, **kw):
+            yield o.EmgUser(issue, self._url)
+
+    async def emgprojects(
+        self, **kw: Any
+    ) -> AsyncGenerator[o.EmgProject, None]:
+        async for issue in self.issues(_u.project.EmgProjects, **kw):
+            yield o.EmgProject(issue, self._url)
+
+    # see Connection for why filterability is probed and every object
+    # returned is checked against the requested value
+
+    async def filterable(self, project_id: str, field: _fd.cf) -> bool:
+        key = (project_id, field)
+        if key not in self._filterable:
+            _, total = await self._page(
+                {
+                    "project_id": project_id,
+                    "status_id": "*",
+                    "limit": 1,
+                    field.value.search_id: uuid.uuid4().hex,
+                }
+            )
+            self._filterable[key] = total == 0
+        return self._filterable[key]
+
+    async def _mustfilter(self, project_id: str, field: _fd.cf) -> None:
+        if not await self.filterable(project_id, field):
+            raise _unfilterable(project_id, field)
+
+    async def _emgusers_for_cf(
+        self, field: _fd.cf, value: str, status: str = "open"
+    ) -> List[o.EmgUser]:
+        await self._mustfilter(_u.project.EmgUsers, field)
+        issues = await self._filter(
+            project_id=_u.project.EmgUsers,
+            status_id=status,
+            **{field.value.search_id: value},
+        )
+        return _checked(o.EmgUser, issues, self._url, field, value)
+
+    async def _emgprojects_for_cf(
+        self, field: _fd.cf, value: str
+    ) -> List[o.EmgProject]:
+        await self._mustfilter(_u.project.EmgProjects, field)
+        issues = await self._filter(
+            project_id=_u.project.EmgProjects,
+            **{field.value.search_id: value},
+        )
+        return _checked(o.EmgProject, issues, self._url, field, value)
+
+    async def emguser_for_ldap(
+        self, ldap: str, status: str = "open"
+    ) -> Optional[o.EmgUser]:
+        users = await self._emgusers_for_cf(_fd.cf.LDAP_UserName, ldap, status)
+        if not users:
+            return None
+        assert len(users) == 1
+        return users[0]
+
+    async def emguser_for_email(self, email: str) -> Optional[o.EmgUser]:
+        users = await self._emgusers_for_cf(_fd.cf.PrimaryUserEmail, email)
+        if not users:
+            return None
+        assert len(users) == 1
+        return users[0]
+
+    async def emgusers_for_email(self, email: str) -> List[o.EmgUser]:
+        return await self._emgusers_for_cf(_fd.cf.PrimaryUserEmail, email)
+
+    async def emgusers_for_pi_email(self, email: str) -> List[o.EmgUser]:
+        return await self._emgusers_for_cf(_fd.cf.PI_Email, email)
+
+    async def emgusers_for_ppms_group(self, group: str) -> List[o.EmgUser]:
+        return await self._emgusers_for_cf(_fd.cf.PPMS_Group, group)
+
+    async def emgprojects_for_email(self, email: str) -> List[o.EmgProject]:
+        return await self._emgprojects_for_cf(_fd.cf.PrimaryUserEmail, email)
+
+    async def emgprojects_for_pi_email(self, email: str) -> List[o.EmgProject]:
+        return await self._emgprojects_for_cf(_fd.cf.PI_Email, email)
+
+    async def emgprojects_for_ppms_group(
+        self, group: str
+    ) -> List[o.EmgProject]:
+        return await self._emgprojects_for_cf(_fd.cf.PPMS_Group, group)
+
+    # as Connection.update()/close(): one request per issue, and a report
+    # mapping every issue written to None or the exception it raised
+
+    # pylint: disable=protected-access
+    async def update(
+        self, *args: o.Base
+    ) -> Dict[int, Optional[BaseException]]:
+        pending = _merge(args)
+
+        async def write(issue_id: int) -> None:
+            objs, fields = pending[issue_id]
+            cf = [{"id": k, "value": v} for k, v in fields.items()]
+            await self._put(issue_id, {"custom_fields": cf})
+            for a in objs:
+                a._commit(fields)
+
+        return await _each(write, pending)
+
+    async def close(self, *args: o.Base) -> Dict[int, Optional[BaseException]]:
+        return await _each(
+            lambda issue_id: self._put(issue_id, {"status_id": 5}),
+            dict.fromkeys(a.id() for a in args),
+        )
+
+    async def _put(self, issue_id: int, fields: Dict[str, Any]) -> None:
+        await self._json(
+            "PUT", f"/issues/{issue_id}.json", body={"issue": fields}
+        )
+
+
+async def _cancel(tasks: Iterable["asyncio.Future[Any]"]) -> None:
+    "cancels tasks and waits for them, so none of their exceptions is lost"
+    tasks = list(tasks)
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _all(aws: Iterable[Awaitable[_R]]) -> List[_R]:
+    """asyncio.gather(), except that once one fails the others are
+    cancelled and waited for before the exception is raised"""
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        await _cancel(tasks)
+
+
+async def _each(
+    fn: Callable[[int], Awaitable[Any]], ids: Iterable[int]
+) -> Dict[int, Optional[BaseException]]:
+    ids = list(ids)
+    results = await asyncio.gather(*map(fn, ids), return_exceptions=True)
+    return {
+        i: r if isinstance(r, BaseException) else None
+        for i, r in zip(ids, results)
+    }
+
+
+__all__ = ["AsyncConnection"]
@@ -1,27 +1,179 @@
-from typing import Any, Dict, Generator, List, Optional
+import threading
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+)
 
 import redminelib
+import redminelib.engines
+import redminelib.exceptions
+import requests.adapters
+import requests.exceptions
 from redminelib.resources.standard import Issue as RedmineIssue
 
+from .. import policy as _policy
+from ..policy import Policy
 from . import _fd, _u, o
 
+_T = TypeVar("_T", bound=o.Base)
+
+
+def _pack(
+    values: Iterable[str], budget: int = 1500
+) -> Generator[Set[str], None, None]:
+    "splits values into chunks whose url-encoded, |-joined length <= budget"
+    chunk: Set[str] = set()
+    size = 0
+    for v in values:
+        assert "|" not in v, f"{v} cannot be packed into a cf filter"
+        n = len(urllib.parse.quote(v, safe="")) + 3  # %7C
+        if chunk and size + n > budget:
+            yield chunk
+            chunk, size = set(), 0
+        chunk.add(v)
+        size += n
+    if chunk:
+        yield chunk
+
+
+def _each(
+    fn: Callable[[int], Any], ids: Iterable[int], workers: int
+) -> Dict[int, Optional[BaseException]]:
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {i: pool.submit(fn, i) for i in ids}
+    return {i: f.exception() for i, f in futures.items()}
+
+
+_Pending = Dict[int, Tuple[List[o.Base], Dict[int | str, int | str]]]
+
+
+def _merge(args: Iterable[o.Base]) -> _Pending:
+    """issue id -> (objects, {field id: value}) of the pending custom field
+    changes of args; objects wrapping the same issue are merged into one
+    write, the later object's value winning where they disagree"""
+    pending: _Pending = {}
+    for a in {id(a): a for a in args}.values():
+        _, cf = a._pending()  # pylint: disable=protected-access
+        if not cf:
+            continue
+        objs, fields = pending.setdefault(a.id(), ([], {}))
+        objs.append(a)
+        fields.update((f["id"], f["value"]) for f in cf)
+    return pending
+
+
+def _unfilterable(project_id: str, field: _fd.cf) -> Exception:
+    return Exception(
+        f"custom field [{field.value.name}] is not filterable in"
+        f" [{project_id}]; use an Index for local lookups"
+    )
+
+
+def _checked(
+    cls: Type[_T],
+    issues: Iterable[RedmineIssue],
+    url: str,
+    field: _fd.cf,
+    value: str,
+) -> List[_T]:
+    "issues as cls objects, each asserted to carry value (see filterable())"
+    objs = [cls(issue, url) for issue in issues]
+    assert field.value.attr
+    for obj in objs:
+        if getattr(obj, field.value.attr) != value:
+            raise Exception(
+                f"{obj}\n {getattr(obj, field.value.attr)} != {value}"
+            )
+    return objs
+
+
+def _transient(e: Exception) -> bool:
+    if isinstance(e, redminelib.exceptions.UnknownError):
+        return e.status_code in (429, 502, 503, 504)
+    return isinstance(
+        e,
+        (
+            redminelib.exceptions.ServerError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ),
+    )
+
+
+class _Engine(redminelib.engines.SyncEngine):  # type: ignore[misc]
+    "runs every request python-redmine makes under a Policy"
+
+    def __init__(self, **options: Any) -> None:
+        self._policy: Optional[Policy] = options.pop("policy", None)
+        super().__init__(**options)
+
+    def request(self, *args: Any, **kw: Any) -> Any:
+        return _policy.run(
+            self._policy, _transient, super().request, *args, **kw
+        )
+
 
 class Connection:
-    def __init__(self, url: str, key: str) -> None:
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        pool_size: int = 10,
+        policy: Optional[Policy] = None,
+    ) -> None:
         self._url = url
-        self._conn = redminelib.Redmine(url, key=key)
+        self._conn = redminelib.Redmine(
+            url, key=key, engine=_Engine, policy=policy
+        )
+        # keep-alive connections for the worker threads of issues()/update()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size
+        )
+        for prefix in ("http://", "https://"):
+            self._conn.engine.session.mount(prefix, adapter)
+        self._filterable: Dict[Tuple[str, _fd.cf], bool] = {}
 
     def get(self, redmine_id: int) -> RedmineIssue:
         return self._conn.issue.get(redmine_id)
 
+    def resource(self, raw: Dict[str, Any]) -> RedmineIssue:
+        "builds an issue from its raw json without a request"
+        return self._conn.issue.to_resource(raw)
+
+    def closed_statuses(self) -> Set[int]:
+        "ids of the issue statuses redmine counts as closed"
+        return {
+            s.id
+            for s in self._conn.issue_status.all()
+            if getattr(s, "is_closed", False)
+        }
+
     def issues(
         self,
         project_id: str,
         updated_on: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = 25,
+        workers: int = 1,
     ) -> Generator[RedmineIssue, None, None]:
+        """with workers > 1 the pages following the first one are fetched
+        concurrently (total_count is known after the first page); issues are
+        still yielded in offset order"""
         # yield self._conn.issue.get(19188)
         # return
-        limit = 25
+        limit = min(limit, 100)  # redmine caps limit at 100
         kw: Dict[str, Any] = {
             "project_id": project_id,
             "limit": limit,
@@ -29,13 +181,68 @@ class Connection:
         }
         if updated_on:
             kw["updated_on"] = ">=" + updated_on
+        if status:
+            kw["status_id"] = status
+        if workers > 1:
+            first = self._conn.issue.filter(**kw)
+            issues: List[RedmineIssue] = list(first)
+            yield from issues
+            if len(issues) < limit:
+                return
+            offsets = range(limit, first.total_count, limit)
+            pool = ThreadPoolExecutor(max_workers=workers)
+            try:
+                for page in pool.map(
+                    lambda offset: self._page(dict(kw, offset=offset)),
+                    offsets,
+                ):
+                    yield from page
+            finally:
+                # don't keep fetching pages if the caller stops early
+                pool.shutdown(cancel_futures=True)
+            # pick up issues created after total_count was read
+            kw["offset"] = limit * (len(offsets) + 1)
         while True:
-            issues: List[RedmineIssue] = self._conn.issue.filter(**kw)
+            issues = self._page(kw)
             if not issues:
                 break
             yield from issues
             kw["offset"] += limit
 
+    def stream(
+        self,
+        project_id: str,
+        after: int = 0,
+        updated_on: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = 100,
+    ) -> Generator[Tuple[int, RedmineIssue], None, None]:
+        """yields (checkpoint, issue) in id order; pass the last checkpoint
+        processed back as after to resume a crawl past it.  Pages are keyed
+        on the id instead of an offset so issues created or closed during
+        the crawl don't shift the remaining pages."""
+        limit = min(limit, 100)  # redmine caps limit at 100
+        kw: Dict[str, Any] = {
+            "project_id": project_id,
+            "sort": "id",
+            "limit": limit,
+        }
+        if updated_on:
+            kw["updated_on"] = ">=" + updated_on
+        if status:
+            kw["status_id"] = status
+        while True:
+            kw["issue_id"] = f">={after + 1}"
+            issues = self._page(kw)
+            for issue in issues:
+                after = issue.id
+                yield after, issue
+            if len(issues) < limit:
+                break
+
+    def _page(self, kw: Dict[str, Any]) -> List[RedmineIssue]:
+        return list(self._conn.issue.filter(**kw))
+
     def emgusers(self, **kw: Any) -> Generator[o.EmgUser, None, None]:
         for issue in self.issues(_u.project.EmgUsers, **kw):
             yield o.EmgUser(issue, self._url)
@@ -44,50 +251,69 @@ class Connection:
         for issue in self.issues(_u.project.EmgProjects, **kw):
             yield o.EmgProject(issue, self._url)
 
+    def emguser_snapshots(
+        self, **kw: Any
+    ) -> Generator[o.EmgUserSnapshot, None, None]:
+        for issue in self.issues(_u.project.EmgUsers, **kw):
+            yield o.EmgUserSnapshot(issue, self._url)
+
+    def emgproject_snapshots(
+        self, **kw: Any
+    ) -> Generator[o.EmgProjectSnapshot, None, None]:
+        for issue in self.issues(_u.project.EmgProjects, **kw):
+            yield o.EmgProjectSnapshot(issue, self._url)
+
+    # pylint: disable=protected-access
+    def thaw(self, snap: o.Snapshot) -> o.Base:
+        "writable object for a snapshot, built without a request"
+        return snap.base(self.resource(snap.raw()), snap._url)
+
     # Redmine Bug?  If a request for a cf (custom field) is made to a field
     # that's not flagged as "filter" and "searchable" redmine seems to return
     # all issues in the project the issue belongs to.  This is bad bad bad!
     # To prevent modifying redmine issues that do not conform to the request,
     # assert the attribute in the object returned = the requested value.
+    # filterable() probes for this once per field, before any data is pulled.
+
+    def filterable(self, project_id: str, field: _fd.cf) -> bool:
+        key = (project_id, field)
+        if key not in self._filterable:
+            # no issue carries a random value, so only an ignored filter
+            # can match anything
+            probe = self._conn.issue.filter(
+                project_id=project_id,
+                status_id="*",
+                limit=1,
+                **{field.value.search_id: uuid.uuid4().hex},
+            )
+            list(probe)
+            self._filterable[key] = probe.total_count == 0
+        return self._filterable[key]
+
+    def _mustfilter(self, project_id: str, field: _fd.cf) -> None:
+        if not self.filterable(project_id, field):
+            raise _unfilterable(project_id, field)
 
     def _emgusers_for_cf(
         self, field: _fd.cf, value: str, status: str = "open"
     ) -> List[o.EmgUser]:
+        self._mustfilter(_u.project.EmgUsers, field)
         issues: List[RedmineIssue] = self._conn.issue.filter(
             project_id=_u.project.EmgUsers,
             status_id=status,
             **{field.value.search_id: value},
         )
-        if not issues:
-            return []
-        users = list(map(lambda issue: o.EmgUser(issue, self._url), issues))
-        assert field.value.attr
-        for user in users:
-            if getattr(user, field.value.attr) != value:
-                raise Exception(
-                    f"{user}\n {getattr(user, field.value.attr)} != {value}"
-                )
-        return users
+        return _checked(o.EmgUser, issues, self._url, field, value)
 
     def _emgprojects_for_cf(
         self, field: _fd.cf, value: str
     ) -> List[o.EmgProject]:
+        self._mustfilter(_u.project.EmgProjects, field)
         issues: List[RedmineIssue] = self._conn.issue.filter(
             project_id=_u.project.EmgProjects,
             **{field.value.search_id: value},
         )
-        if not issues:
-            return []
-        projects = list(
-            map(lambda issue: o.EmgProject(issue, self._url), issues)
-        )
-        assert field.value.attr
-        for p in projects:
-            if getattr(p, field.value.attr) != value:
-                raise Exception(
-                    f"{p}\n {getattr(p, field.value.attr)} != {value}"
-                )
-        return projects
+        return _checked(o.EmgProject, issues, self._url, field, value)
 
     def emguser_for_ldap(
         self, ldap: str, status: str = "open"
@@ -124,34 +350,178 @@ class Connection:
     def emgprojects_for_pi_email(self, email: str) -> List[o.EmgProject]:
         return self._emgprojects_for_cf(_fd.cf.PI_Email, email)
 
-    def emgprojects_for_pppms_group(self, group: str) -> List[o.EmgProject]:
+    def emgprojects_for_ppms_group(self, group: str) -> List[o.EmgProject]:
         return self._emgprojects_for_cf(_fd.cf.PPMS_Group, group)
 
+    # the old, misspelt name
+    emgprojects_for_pppms_group = emgprojects_for_ppms_group
+
+    # batched variants of the above: values are packed into as few
+    # "|"-separated cf_N filters as the url length allows; the result maps
+    # every requested value to the objects that carry it
+
+    def _objects_for_cfs(
+        self,
+        cls: Type[_T],
+        project_id: str,
+        field: _fd.cf,
+        values: Iterable[str],
+        **kw: Any,
+    ) -> Dict[str, List[_T]]:
+        assert field.value.attr
+        self._mustfilter(project_id, field)
+        found: Dict[str, List[_T]] = {v: [] for v in values}
+        for chunk in _pack(found):
+            issues: List[RedmineIssue] = self._conn.issue.filter(
+                project_id=project_id,
+                **kw,
+                **{field.value.search_id: "|".join(chunk)},
+            )
+            for issue in issues:
+                x = cls(issue, self._url)
+                if (v := getattr(x, field.value.attr)) not in chunk:
+                    raise Exception(f"{x}\n {v} not in {sorted(chunk)}")
+                found[v].append(x)
+        return found
+
+    def _emgusers_for_cfs(
+        self, field: _fd.cf, values: Iterable[str], status: str = "open"
+    ) -> Dict[str, List[o.EmgUser]]:
+        return self._objects_for_cfs(
+            o.EmgUser, _u.project.EmgUsers, field, values, status_id=status
+        )
+
+    def _emgprojects_for_cfs(
+        self, field: _fd.cf, values: Iterable[str]
+    ) -> Dict[str, List[o.EmgProject]]:
+        return self._objects_for_cfs(
+            o.EmgProject, _u.project.EmgProjects, field, values
+        )
+
+    def emgusers_for_ldaps(
+        self, ldaps: Iterable[str], status: str = "open"
+    ) -> Dict[str, List[o.EmgUser]]:
+        return self._emgusers_for_cfs(_fd.cf.LDAP_UserName, ldaps, status)
+
+    def emgusers_for_emails(
+        self, emails: Iterable[str]
+    ) -> Dict[str, List[o.EmgUser]]:
+        return self._emgusers_for_cfs(_fd.cf.PrimaryUserEmail, emails)
+
+    def emgusers_for_pi_emails(
+        self, emails: Iterable[str]
+    ) -> Dict[str, List[o.EmgUser]]:
+        return self._emgusers_for_cfs(_fd.cf.PI_Email, emails)
+
+    def emgusers_for_ppms_groups(
+        self, groups: Iterable[str]
+    ) -> Dict[str, List[o.EmgUser]]:
+        return self._emgusers_for_cfs(_fd.cf.PPMS_Group, groups)
+
+    def emgprojects_for_emails(
+        self, emails: Iterable[str]
+    ) -> Dict[str, List[o.EmgProject]]:
+        return self._emgprojects_for_cfs(_fd.cf.PrimaryUserEmail, emails)
+
+    def emgprojects_for_pi_emails(
+        self, emails: Iterable[str]
+    ) -> Dict[str, List[o.EmgProject]]:
+        return self._emgprojects_for_cfs(_fd.cf.PI_Email, emails)
+
+    def emgprojects_for_ppms_groups(
+        self, groups: Iterable[str]
+    ) -> Dict[str, List[o.EmgProject]]:
+        return self._emgprojects_for_cfs(_fd.cf.PPMS_Group, groups)
+
+    # writes run on up to workers threads; the returned report maps every
+    # issue written to None on success or to the exception it raised
+
     # pylint: disable=protected-access
-    def update(self, *args: o.Base) -> None:
-        for a in args:
-            _, cf = a._pending()
-            if not cf:
-                continue
-            self._conn.issue.update(a.id(), custom_fields=cf)
-            a._commit()
+    def update(
+        self, *args: o.Base, workers: int = 1
+    ) -> Dict[int, Optional[BaseException]]:
+        """pending changes of objects wrapping the same issue are merged into
+        one request (later objects win, see _merge); once the write succeeds
+        each object's fields are marked clean, except those whose value lost
+        to a later object's and so was never written"""
+        pending = _merge(args)
+
+        def write(issue_id: int) -> None:
+            objs, fields = pending[issue_id]
+            self._conn.issue.update(
+                issue_id,
+                custom_fields=[
+                    {"id": k, "value": v} for k, v in fields.items()
+                ],
+            )
+            for a in objs:
+                a._commit(fields)
 
-    def close(self, *args: o.Base) -> None:
-        for a in args:
-            self._conn.issue.update(a.id(), status_id=5)
+        return _each(write, pending, workers)
+
+    def close(
+        self, *args: o.Base, workers: int = 1
+    ) -> Dict[int, Optional[BaseException]]:
+        return _each(
+            lambda issue_id: self._conn.issue.update(issue_id, status_id=5),
+            dict.fromkeys(a.id() for a in args),
+            workers,
+        )
 
 
 class LazyConnection:
-    def __init__(self, url: str, key: str) -> None:
+    "the Connection is built on first call, once, even across threads"
+
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        pool_size: int = 10,
+        policy: Optional[Policy] = None,
+    ) -> None:
         self._url = url
         self._key = key
+        self._pool_size = pool_size
+        self._policy = policy
+        self._lock = threading.Lock()
         self._conn: Optional[Connection] = None
 
     def __call__(self) -> Connection:
         if self._conn:
             return self._conn
-        self._conn = Connection(self._url, self._key)
-        return self._conn
+        with self._lock:
+            if not self._conn:
+                self._conn = Connection(
+                    self._url, self._key, self._pool_size, self._policy
+                )
+            return self._conn
+
+
+class ConnectionPool:
+    """drop-in for LazyConnection that lazily builds one Connection, and so
+    one http session, per calling thread"""
+
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        pool_size: int = 10,
+        policy: Optional[Policy] = None,
+    ) -> None:
+        self._url = url
+        self._key = key
+        self._pool_size = pool_size
+        self._policy = policy
+        self._local = threading.local()
+
+    def __call__(self) -> Connection:
+        conn: Optional[Connection] = getattr(self._local, "conn", None)
+        if not conn:
+            conn = Connection(
+                self._url, self._key, self._pool_size, self._policy
+            )
+            self._local.conn = conn
+        return conn
 
 
-__all__ = ["Connection", "LazyConnection"]
+__all__ = ["Connection", "ConnectionPool", "LazyConnection"]
@@ -0,0 +1,91 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional, Union
+
+from . import _fd, o
+from ._conn import Connection
+from ._mirror import Mirror
+
+_Table = Dict[_fd.cf, Dict[str, List[o.EmgUser]]]
+
+
+class Index:
+    """in-memory emg-users lookups, one hash index per _fd.cf with an attr.
+
+    The whole project is loaded from source (a Connection or a Mirror) on
+    first use and reloaded once it is older than ttl seconds.  kw is passed
+    on to source.emgusers().  Every lookup returns new EmgUser objects over
+    the loaded issues, which setters leave alone."""
+
+    fields = [f for f in _fd.cf if f.value.attr]
+
+    def __init__(
+        self, source: Union[Connection, Mirror], ttl: float = 300, **kw: Any
+    ) -> None:
+        self._source = source
+        self._ttl = ttl
+        self._kw = kw
+        self._lock = threading.Lock()
+        self._table: Optional[_Table] = None
+        self._loaded = 0.0
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._table = None
+
+    # pylint: disable=protected-access
+    def _load(self) -> _Table:
+        with self._lock:
+            if (
+                self._table is not None
+                and time.monotonic() - self._loaded < self._ttl
+            ):
+                return self._table
+            table: _Table = {f: {} for f in Index.fields}
+            for user in self._source.emgusers(status="*", **self._kw):
+                for f, idx in table.items():
+                    v = user._cf().custom(f.value.name)
+                    if v is not None:
+                        idx.setdefault(v, []).append(user)
+            self._table = table
+            self._loaded = time.monotonic()
+            return table
+
+    def _emgusers_for_cf(
+        self, field: _fd.cf, value: str, status: str = "open"
+    ) -> List[o.EmgUser]:
+        users = self._load()[field].get(value, [])
+        if status != "*":
+            closed = status == "closed"
+            users = [u for u in users if u.closed() == closed]
+        # fresh wrappers, so that a caller's pending changes stay its own
+        # rather than showing up in every later lookup
+        return [o.EmgUser(u._issue, u._url) for u in users]
+
+    def emguser_for_ldap(
+        self, ldap: str, status: str = "open"
+    ) -> Optional[o.EmgUser]:
+        users = self._emgusers_for_cf(_fd.cf.LDAP_UserName, ldap, status)
+        if not users:
+            return None
+        assert len(users) == 1
+        return users[0]
+
+    def emguser_for_email(self, email: str) -> Optional[o.EmgUser]:
+        users = self._emgusers_for_cf(_fd.cf.PrimaryUserEmail, email)
+        if not users:
+            return None
+        assert len(users) == 1
+        return users[0]
+
+    def emgusers_for_email(self, email: str) -> List[o.EmgUser]:
+        return self._emgusers_for_cf(_fd.cf.PrimaryUserEmail, email)
+
+    def emgusers_for_pi_email(self, email: str) -> List[o.EmgUser]:
+        return self._emgusers_for_cf(_fd.cf.PI_Email, email)
+
+    def emgusers_for_ppms_group(self, group: str) -> List[o.EmgUser]:
+        return self._emgusers_for_cf(_fd.cf.PPMS_Group, group)
+
+
+__all__ = ["Index"]
@@ -0,0 +1,161 @@
+import json
+import sqlite3
+import threading
+from typing import Any, Generator, List, Optional, Set
+
+from redminelib.resources.standard import Issue as RedmineIssue
+
+from . import _fd, _u, o, util
+from ._conn import Connection
+
+_schema = """
+CREATE TABLE IF NOT EXISTS issue (
+    id INTEGER PRIMARY KEY,
+    project TEXT NOT NULL,
+    updated_on TEXT NOT NULL,
+    closed INTEGER NOT NULL,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS issue_project ON issue (project, closed);
+CREATE TABLE IF NOT EXISTS custom (
+    issue INTEGER NOT NULL,
+    field INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (issue, field)
+);
+CREATE INDEX IF NOT EXISTS custom_value ON custom (field, value);
+CREATE TABLE IF NOT EXISTS hwm (
+    project TEXT PRIMARY KEY,
+    updated_on TEXT NOT NULL
+);
+"""
+
+
+class Mirror:
+    """local sqlite copy of redmine projects keyed by issue id.
+
+    refresh() only asks redmine for issues updated since the stored
+    high-water mark; issues deleted in redmine are not noticed.  An issue
+    is closed when redmine counts its status as closed (is_closed), which
+    refresh() looks up again every time.  Each thread gets its own
+    connection to the database file at path, so path must be a file;
+    close() closes them all."""
+
+    # pylint: disable=protected-access
+    def __init__(self, conn: Connection, path: str) -> None:
+        if path in ("", ":memory:"):
+            # every connection would get a database of its own
+            raise Exception(f"Mirror needs a database file, not [{path}]")
+        self._conn = conn
+        self._url = conn._url
+        self._path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._dbs: List[sqlite3.Connection] = []
+        # readers go on while refresh() writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_schema)
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        db: Optional[sqlite3.Connection] = getattr(self._local, "db", None)
+        if db is None:
+            # only ever used on this thread, but close() may run on another
+            db = sqlite3.connect(
+                self._path, timeout=60, check_same_thread=False
+            )
+            with self._lock:
+                self._dbs.append(db)
+            self._local.db = db
+        return db
+
+    def close(self) -> None:
+        "closes every thread's connection"
+        with self._lock:
+            dbs, self._dbs = self._dbs, []
+        for db in dbs:
+            db.close()
+        self._local = threading.local()
+
+    def hwm(self, project_id: str) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT updated_on FROM hwm WHERE project = ?", (project_id,)
+        ).fetchone()
+        return None if row is None else str(row[0])
+
+    def refresh(self, project_id: str, **kw: Any) -> int:
+        "returns the number of issues fetched"
+        closed = self._conn.closed_statuses()
+        n = 0
+        with self._db:
+            # statuses can be reconfigured, so issues already stored are
+            # checked against them too
+            ids = sorted(closed)
+            expr = "(json_extract(raw, '$.status.id') IN (%s))" % ",".join(
+                "?" * len(ids)
+            )
+            self._db.execute(
+                f"UPDATE issue SET closed = {expr} WHERE closed != {expr}",
+                ids + ids,
+            )
+            for issue in self._conn.issues(
+                project_id,
+                updated_on=self.hwm(project_id),
+                status="*",
+                **kw,
+            ):
+                self._store(project_id, issue, closed)
+                n += 1
+            # updated_on is ISO 8601 in UTC so it sorts as text
+            self._db.execute(
+                "INSERT OR REPLACE INTO hwm (project, updated_on) "
+                "SELECT project, MAX(updated_on) FROM issue "
+                "WHERE project = ? GROUP BY project",
+                (project_id,),
+            )
+        return n
+
+    def _store(
+        self, project_id: str, issue: RedmineIssue, closed_ids: Set[int]
+    ) -> None:
+        raw = issue.raw()
+        closed = issue.status.id in closed_ids
+        self._db.execute(
+            "INSERT OR REPLACE INTO issue "
+            "(id, project, updated_on, closed, raw) VALUES (?, ?, ?, ?, ?)",
+            (issue.id, project_id, raw["updated_on"], closed, json.dumps(raw)),
+        )
+        self._db.execute("DELETE FROM custom WHERE issue = ?", (issue.id,))
+        cfs = util.CustomIndex(issue)
+        for field in _fd.cf:
+            if (v := cfs.custom(field.value.name)) is None:
+                continue
+            self._db.execute(
+                "INSERT INTO custom (issue, field, value) VALUES (?, ?, ?)",
+                (issue.id, field.value.id, v),
+            )
+
+    def issues(
+        self, project_id: str, status: str = "open"
+    ) -> Generator[RedmineIssue, None, None]:
+        "status is one of open, closed or *, as in redmine's status_id"
+        sql = "SELECT raw FROM issue WHERE project = ?"
+        if status != "*":
+            sql += f" AND closed = {int(status == 'closed')}"
+        for (raw,) in self._db.execute(sql + " ORDER BY id", (project_id,)):
+            yield self._conn.resource(json.loads(raw))
+
+    def emgusers(
+        self, status: str = "open"
+    ) -> Generator[o.EmgUser, None, None]:
+        for issue in self.issues(_u.project.EmgUsers, status):
+            yield o.EmgUser(issue, self._url)
+
+    def emgprojects(
+        self, status: str = "open"
+    ) -> Generator[o.EmgProject, None, None]:
+        for issue in self.issues(_u.project.EmgProjects, status):
+            yield o.EmgProject(issue, self._url)
+
+
+__all__ = ["Mirror"]
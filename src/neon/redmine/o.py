@@ -1,5 +1,6 @@
 import datetime
-from typing import Dict, Final, List, Tuple, cast
+import sys
+from typing import Any, Dict, Final, List, Optional, Tuple, cast
 
 from redminelib.resources.standard import Issue as RedmineIssue
 
@@ -36,6 +37,7 @@ class Base:
         self._issue = issue
         self._url = url
         self._custom_fields: Dict[_fd.cf, Base._Field] = {}
+        self._cfindex: Optional[util.CustomIndex] = None
 
     def id(self) -> int:
         x: Final = self._issue.id
@@ -53,15 +55,22 @@ class Base:
         assert isinstance(other, Base)
         return self.id() == other.id()
 
-    def _commit(self) -> None:
-        for f in self._custom_fields.values():
-            f.clean()
+    def _commit(self, sent: Dict[int | str, int | str]) -> None:
+        "marks clean the fields whose value is the one sent (id -> value)"
+        for k, f in self._custom_fields.items():
+            if k.value.id in sent and sent[k.value.id] == f.value:
+                f.clean()
+
+    def _cf(self) -> util.CustomIndex:
+        if self._cfindex is None:
+            self._cfindex = util.CustomIndex(self._issue)
+        return self._cfindex
 
     def _custom(self, field: _fd.cf) -> _Field:
         if not field in self._custom_fields:
             self._custom_fields[field] = Base._Field(
                 name=field.value.name,
-                value=util.mustcustom(self._issue, field.value.name),
+                value=self._cf().mustcustom(field.value.name),
             )
         return self._custom_fields[field]
 
@@ -144,11 +153,11 @@ class EmgUser(Base):
 class EmgProject(Base):
     @property
     def ppms_group(self) -> str:
-        return util.mustcustom(self._issue, "PPMS Group Identifier")
+        return self._custom(_fd.cf.PPMS_Group).value
 
     @property
     def primary_user_name(self) -> str:
-        return util.mustcustom(self._issue, "Primary User Name")
+        return self._cf().mustcustom("Primary User Name")
 
     @property
     def start_date(self) -> datetime.date:
@@ -158,7 +167,7 @@ class EmgProject(Base):
 
     @property
     def institution(self) -> str:
-        return util.mustcustom(self._issue, "Institution")
+        return self._cf().mustcustom("Institution")
 
     @property
     def nc_project_id(self) -> str:
@@ -174,7 +183,7 @@ class EmgProject(Base):
 
 class Proposal_v2(Base):
     def nc_project_id(self) -> str:
-        return util.mustcustom(self._issue, "NC-Project ID")
+        return self._cf().mustcustom("NC-Project ID")
 
     @property
     def labmailingaddress(self) -> str:
@@ -207,3 +216,136 @@ class Proposal_v2(Base):
     @zip.setter
     def zip(self, value: str) -> None:
         self._custom(_fd.cf.NC_Zip).value = value
+
+
+# Snapshots are compact, read-only copies of an issue that keep only the
+# id, status, start_date and the _fd.cf values; Connection.thaw() turns one
+# back into its writable Base class.
+
+
+class Snapshot:
+    __slots__ = ("_id", "_status", "_start_date", "_values", "_url")
+    _fields: Final = tuple(_fd.cf)
+    _pos: Final = {f: i for i, f in enumerate(_fields)}
+    base: type[Base] = Base
+
+    def __init__(self, issue: RedmineIssue, url: str = "") -> None:
+        self._id: Final[int] = issue.id
+        self._status: Final[str] = issue.status.name  # pyright: ignore
+        self._start_date: Final[Optional[datetime.date]] = getattr(
+            issue, "start_date", None
+        )
+        cfs = util.CustomIndex(issue)
+        # values such as pi emails and ppms groups repeat across issues
+        self._values: Final = tuple(
+            None if (v := cfs.custom(f.value.name)) is None else sys.intern(v)
+            for f in Snapshot._fields
+        )
+        self._url = url
+
+    def id(self) -> int:
+        return self._id
+
+    def closed(self) -> bool:
+        return self._status.lower().strip() == "closed"
+
+    def __hash__(self) -> int:
+        return self._id
+
+    def __eq__(self, other: object) -> bool:
+        assert isinstance(other, Snapshot)
+        return self._id == other._id
+
+    def _value(self, field: _fd.cf) -> str:
+        if (v := self._values[Snapshot._pos[field]]) is None:
+            raise Exception(
+                f"issue [{self._id}] does not define custom field"
+                f" [{field.value.name}]"
+            )
+        return v
+
+    def raw(self) -> Dict[str, Any]:
+        "issue json with just the fields kept, see Connection.thaw()"
+        raw: Dict[str, Any] = {
+            "id": self._id,
+            "status": {"name": self._status},
+            "custom_fields": [
+                {"id": f.value.id, "name": f.value.name, "value": v}
+                for f, v in zip(Snapshot._fields, self._values)
+                if v is not None
+            ],
+        }
+        if self._start_date:
+            raw["start_date"] = self._start_date.isoformat()
+        return raw
+
+    @property
+    def email(self) -> str:
+        return self._value(_fd.cf.PrimaryUserEmail)
+
+    @property
+    def pi_email(self) -> str:
+        return self._value(_fd.cf.PI_Email)
+
+    @property
+    def ppms_group(self) -> str:
+        return self._value(_fd.cf.PPMS_Group)
+
+    @property
+    def url(self) -> str:
+        return f"{self._url}/issues/{self._id}"
+
+    def __str__(self) -> str:
+        return f"#{self._id} ({self.url})"
+
+
+class EmgUserSnapshot(Snapshot):
+    __slots__ = ()
+    base = EmgUser
+
+    def ispi(self) -> bool:
+        return self.email == self.pi_email
+
+    @property
+    def pi(self) -> str:
+        return self._value(_fd.cf.PI)
+
+    @property
+    def firstname(self) -> str:
+        return self._value(_fd.cf.FirstName)
+
+    @property
+    def lastname(self) -> str:
+        return self._value(_fd.cf.LastName)
+
+    @property
+    def name(self) -> str:
+        return f"{self.firstname} {self.lastname}"
+
+    @property
+    def labeled_grid_boxes(self) -> str:
+        return self._value(_fd.cf.LabeledGridBoxes)
+
+    @property
+    def ldap(self) -> str:
+        return self._value(_fd.cf.LDAP_UserName)
+
+    def __str__(self) -> str:
+        return f"{self.name} ({self.url})"
+
+
+class EmgProjectSnapshot(Snapshot):
+    "primary_user_name and institution are not _fd.cf fields so aren't kept"
+
+    __slots__ = ()
+    base = EmgProject
+
+    @property
+    def start_date(self) -> datetime.date:
+        x = self._start_date
+        assert isinstance(x, datetime.date)
+        return x
+
+    @property
+    def nc_project_id(self) -> str:
+        return self._value(_fd.cf.NC_ProjectId)
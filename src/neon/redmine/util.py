@@ -1,4 +1,4 @@
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 
 from redminelib.resources.standard import Issue as RedmineIssue
 
@@ -7,6 +7,14 @@ def customfields(issue: RedmineIssue) -> Any:
     return issue.custom_fields.values()  # pyright: ignore
 
 
+def _clean(v: Any) -> str:
+    # custom fields values can be None
+    if not v:
+        return ""
+    assert isinstance(v, str)
+    return v.strip()
+
+
 def custom(issue: RedmineIssue, name: str) -> Optional[str]:
     """returns None if the custom_field is not defined;
     otherwise returns stripped() string"""
@@ -14,12 +22,7 @@ def custom(issue: RedmineIssue, name: str) -> Optional[str]:
         return None
     for field in customfields(issue):
         if field["name"] == name:
-            v = field["value"]
-            # custom fields values can be None
-            if not v:
-                return ""
-            assert isinstance(v, str)
-            return v.strip()
+            return _clean(field["value"])
     return None
 
 
@@ -31,6 +34,39 @@ def mustcustom(issue: RedmineIssue, name: str) -> str:
     return v
 
 
+class CustomIndex:
+    """name -> value and id -> value maps of an issue's custom fields, built
+    once so lookups don't scan the fields; values are as custom() returns"""
+
+    def __init__(self, issue: RedmineIssue) -> None:
+        self._issue = issue
+        self._by_name: Dict[str, Any] = {}
+        self._by_id: Dict[int, Any] = {}
+        if not hasattr(issue, "custom_fields"):
+            return
+        for field in customfields(issue):
+            # the first field of a given name wins, as in custom()
+            self._by_name.setdefault(field["name"], field["value"])
+            self._by_id.setdefault(field["id"], field["value"])
+
+    def custom(self, name: str) -> Optional[str]:
+        if name not in self._by_name:
+            return None
+        return _clean(self._by_name[name])
+
+    def custom_id(self, uid: int) -> Optional[str]:
+        if uid not in self._by_id:
+            return None
+        return _clean(self._by_id[uid])
+
+    def mustcustom(self, name: str) -> str:
+        if (v := self.custom(name)) is None:
+            raise Exception(
+                f"issue [{self._issue.id}] does not define custom field [{name}]"
+            )
+        return v
+
+
 def prcustom(issue: RedmineIssue) -> None:
     for field in customfields(issue):
         print(f"{field['name']} :: {field['value']}")